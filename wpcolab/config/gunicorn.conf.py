@@ -0,0 +1,9 @@
+# Gunicorn settings for the wpcolab workers.
+#
+# Use with: ./manage.py run_gunicorn --config=./config/gunicorn.conf.py
+
+
+def post_fork(server, worker):
+    # imported here because Django isn't configured when this file loads
+    from mobigame.warmup import post_fork
+    post_fork(server, worker)
@@ -1,4 +1,5 @@
-from mobigame.models import Level, Question, Answer, Game, Player
+from mobigame.models import (Level, Question, Answer, Game, Player,
+                             ProfilerConfig)
 from django.contrib import admin
 
 
@@ -13,7 +14,13 @@ class QuestionAdmin(admin.ModelAdmin):
     search_fields = ['text']
 
 
+class ProfilerConfigAdmin(admin.ModelAdmin):
+    list_display = ['__unicode__', 'enabled', 'sample_rate']
+    list_editable = ['enabled', 'sample_rate']
+
+
 admin.site.register(Level)
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(Game)
 admin.site.register(Player)
+admin.site.register(ProfilerConfig, ProfilerConfigAdmin)
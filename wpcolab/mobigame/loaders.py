@@ -0,0 +1,20 @@
+"""Template loading."""
+
+from django.conf import settings
+from django.template.loaders import cached
+
+
+class CachedLoader(cached.Loader):
+    """The cached template loader, except that it reloads templates while
+    DEBUG is on.
+
+    DEBUG is read when each template is loaded rather than when the
+    settings are, so settings modules that import settings.py and then
+    turn off DEBUG get the cache too.
+    """
+
+    def load_template(self, template_name, template_dirs=None):
+        if settings.DEBUG:
+            self.reset()
+        return super(CachedLoader, self).load_template(template_name,
+                                                       template_dirs)
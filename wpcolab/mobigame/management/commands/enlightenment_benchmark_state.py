@@ -0,0 +1,58 @@
+"""Management command for benchmarking game state storage backends."""
+
+import time
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.models import Game, Player
+from mobigame.storage import load_state_store, DEFAULT_STATE_STORE
+
+
+class Command(BaseCommand):
+    help = "Measure load/save throughput of a game state storage backend."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--store', dest='store', default=DEFAULT_STATE_STORE,
+                    type='str', help='Dotted path of the state store'),
+        make_option('--iterations', dest='iterations', default=1000,
+                    type='int', help='Number of load/save cycles'),
+    )
+
+    def handle(self, *args, **options):
+        path = options['store']
+        iterations = options['iterations']
+        store = load_state_store(path)
+
+        game = Game.objects.create(complete=False)
+        players = [Player.objects.create(first_name="Bench %d" % i,
+                                         colour=colour)
+                   for i, (colour, _desc, _style) in enumerate(Player.COLOURS)]
+        try:
+            gamestate = game.get_state(store=store)
+            for player in players:
+                gamestate.add_player(player)
+            gamestate.save()
+
+            start = time.time()
+            for i in range(iterations):
+                # fetch the row and change the state as a request would
+                game = Game.objects.get(pk=game.pk)
+                gamestate = game.get_state(store=store)
+                player = players[i % len(players)]
+                player_state = gamestate['players'][str(player.pk)]
+                # toggle, as unchanged states aren't written
+                player_state['level'] = 1 - player_state['level']
+                gamestate.save()
+            elapsed = time.time() - start
+        finally:
+            store.flush(game)
+            game.delete()
+            for player in players:
+                player.delete()
+
+        print "Store: %s" % path
+        print "  Iterations: %d" % iterations
+        print "  Elapsed: %.3fs" % elapsed
+        print "  Throughput: %.1f load/save cycles per second" % (
+            iterations / elapsed if elapsed else float('inf'))
@@ -0,0 +1,33 @@
+"""Management command for exporting a question bank snapshot."""
+
+import sys
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export levels, questions and answers to a snapshot file."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--filename', dest='filename', default='', type='str',
+                        help='Snapshot file to write'),
+    )
+
+    def handle(self, *args, **options):
+        filename = options['filename']
+        if not filename:
+            sys.exit('Please provide --filename')
+
+        print 'Exporting questions to %s' % filename
+        with open(filename, "wb") as snapshot:
+            trailer = write_snapshot(snapshot)
+
+        print "Summary:"
+        print "  Levels:", trailer['levels']
+        print "  Questions:", trailer['questions']
+        print "  Answers:", trailer['answers']
+        print "  SHA-256:", trailer['sha256']
+        print 'Done'
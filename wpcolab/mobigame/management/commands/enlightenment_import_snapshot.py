@@ -0,0 +1,35 @@
+"""Management command for importing a question bank snapshot."""
+
+import sys
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.snapshot import load_snapshot
+
+
+class Command(BaseCommand):
+    help = "Import levels, questions and answers from a snapshot file."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--filename', dest='filename', default='', type='str',
+                        help='Snapshot file to read'),
+        make_option('--replace', dest='replace', action="store_true",
+                    default=False,
+                    help='Delete the existing questions first'),
+    )
+
+    def handle(self, *args, **options):
+        filename = options['filename']
+        if not filename:
+            sys.exit('Please provide --filename')
+
+        print 'Importing snapshot from %s' % filename
+        with open(filename, "rb") as snapshot:
+            counts = load_snapshot(snapshot, replace=options['replace'])
+
+        print "Summary:"
+        print "  Levels:", counts['levels']
+        print "  Questions:", counts['questions']
+        print "  Answers:", counts['answers']
+        print 'Done'
@@ -0,0 +1,19 @@
+"""Management command for creating request profiling headers."""
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.profiling import sign_profile_header
+
+
+class Command(BaseCommand):
+    help = "Print a signed X-Mobigame-Profile header for profiling requests."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seconds', dest='seconds', default=300, type='int',
+                    help='How long the header stays valid'),
+    )
+
+    def handle(self, *args, **options):
+        print "X-Mobigame-Profile: %s" % sign_profile_header(
+            options['seconds'])
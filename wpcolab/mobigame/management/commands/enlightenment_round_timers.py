@@ -0,0 +1,26 @@
+"""Management command for timing out idle players."""
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.timers import run
+
+
+class Command(BaseCommand):
+    help = "Eliminate players who miss their round deadline."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--poll-interval', dest='poll_interval', default=1.0,
+                    type='float',
+                    help='Seconds between checks for new deadlines'),
+        make_option('--verbose', dest='verbose', action="store_true",
+                    default=False),
+    )
+
+    def handle(self, *args, **options):
+        print 'Watching round timers ...'
+        try:
+            run(poll_interval=options['poll_interval'],
+                verbose=options.get('verbose'))
+        except KeyboardInterrupt:
+            print 'Done'
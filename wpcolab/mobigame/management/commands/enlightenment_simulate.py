@@ -0,0 +1,67 @@
+"""Management command for simulating games offline."""
+
+import sys
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.models import GameState
+from mobigame.simulator import simulate
+
+
+def parse_levels(text):
+    """Parse '1:0.8,2:0.6' into {1: '0.8', 2: '0.6'}."""
+    values = {}
+    for item in text.split(','):
+        level, _, value = item.partition(':')
+        values[int(level)] = value
+    return values
+
+
+class Command(BaseCommand):
+    help = "Simulate games offline to tune round limits and question mix."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--games', dest='games', default=100000, type='int',
+                    help='Number of games to simulate'),
+        make_option('--accuracy', dest='accuracy', default='', type='str',
+                    help='Chance of a correct answer per level,'
+                         ' e.g. 1:0.9,2:0.7,3:0.5'),
+        make_option('--round-limits', dest='round_limits', default='',
+                    type='str',
+                    help='Players going through per round, e.g. 1:3,2:2'),
+        make_option('--last-level', dest='last_level', default=None,
+                    type='int', help='Level that decides the winner'),
+        make_option('--answer-time', dest='answer_time', default=10.0,
+                    type='float',
+                    help='Mean seconds a player takes to answer'),
+        make_option('--processes', dest='processes', default=None,
+                    type='int', help='Worker processes (default: all cores)'),
+        make_option('--seed', dest='seed', default=0, type='int'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['accuracy']:
+            sys.exit('Please provide --accuracy')
+        accuracy = dict((level, float(value)) for level, value
+                        in parse_levels(options['accuracy']).items())
+        round_limits = None
+        if options['round_limits']:
+            round_limits = dict((level, int(value)) for level, value
+                                in parse_levels(options['round_limits'])
+                                                .items())
+        last_level = options['last_level'] or GameState.LAST_LEVEL
+        missing = [level for level in range(1, last_level + 1)
+                   if level not in accuracy]
+        if missing:
+            sys.exit('No accuracy given for levels %s' %
+                     ', '.join(str(level) for level in missing))
+
+        print 'Simulating %d games ...' % options['games']
+        stats = simulate(options['games'], accuracy,
+                         answer_time=options['answer_time'],
+                         last_level=last_level,
+                         round_limits=round_limits,
+                         processes=options['processes'],
+                         seed=options['seed'])
+        stats.print_report()
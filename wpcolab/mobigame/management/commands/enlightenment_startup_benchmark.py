@@ -0,0 +1,28 @@
+"""Management command for timing worker warm-up."""
+
+import time
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from mobigame.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = "Time each worker warm-up stage, cold and then warm."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', dest='runs', default=2, type='int',
+                    help='Number of warm-up runs (the first is cold)'),
+    )
+
+    def handle(self, *args, **options):
+        for run in range(options['runs']):
+            start = time.time()
+            timings = warm_up()
+            total = time.time() - start
+            print "Run %d (%s): %.3fs" % (run + 1,
+                                          "cold" if run == 0 else "warm",
+                                          total)
+            for name, seconds in timings:
+                print "  %s: %.3fs" % (name, seconds)
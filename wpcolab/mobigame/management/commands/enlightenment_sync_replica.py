@@ -0,0 +1,75 @@
+"""Management command for copying the game tables to a read replica.
+
+The replica's tables must exist first: ./manage.py syncdb --database=replica
+"""
+
+import sys
+import time
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_app, get_models
+from optparse import make_option
+
+from mobigame.models import ReplicaHeartbeat
+from mobigame.routers import replica_alias
+
+
+def same_database(alias1, alias2):
+    keys = ['ENGINE', 'NAME', 'HOST', 'PORT']
+    return ([connections[alias1].settings_dict[key] for key in keys] ==
+            [connections[alias2].settings_dict[key] for key in keys])
+
+
+def sync_replica(replica, verbose=False):
+    """Copy every mobigame table from the primary to replica.
+
+    The heartbeat is written first so that the replica's heartbeat never
+    claims to be newer than the data copied with it.
+    """
+    ReplicaHeartbeat.objects.using(DEFAULT_DB_ALIAS).exclude(pk=1).delete()
+    heartbeat = ReplicaHeartbeat(pk=1, beat=datetime.datetime.now())
+    heartbeat.save(using=DEFAULT_DB_ALIAS)
+
+    models = get_models(get_app('mobigame'))
+    with transaction.commit_on_success(using=replica):
+        for model in reversed(models):
+            model._default_manager.using(replica).all().delete()
+        for model in models:
+            rows = 0
+            for obj in model._default_manager.using(DEFAULT_DB_ALIAS)\
+                                             .order_by('pk').iterator():
+                # raw, as loaddata does, so auto_now fields are copied as-is
+                obj.save_base(raw=True, force_insert=True, using=replica)
+                rows += 1
+            if verbose:
+                print "  %s: %d rows" % (model.__name__, rows)
+
+
+class Command(BaseCommand):
+    help = "Copy the game tables from the primary database to the replica."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', dest='interval', default=0, type='float',
+                    help='Keep syncing every INTERVAL seconds'),
+        make_option('--verbose', dest='verbose', action="store_true",
+                    default=False),
+    )
+
+    def handle(self, *args, **options):
+        replica = replica_alias()
+        if replica is None:
+            sys.exit('No replica database configured')
+        if same_database(replica, DEFAULT_DB_ALIAS):
+            sys.exit('The replica is the primary database')
+        interval = options['interval']
+        verbose = options.get('verbose')
+
+        while True:
+            start = time.time()
+            sync_replica(replica, verbose=verbose)
+            print 'Synced %s in %.3fs' % (replica, time.time() - start)
+            if not interval:
+                break
+            time.sleep(max(interval - (time.time() - start), 0))
@@ -1,20 +1,52 @@
 import datetime
+import time
 import json
 import copy
+import random
 
 from django.db import models
 from django.core.validators import MinValueValidator
 
+from mobigame.storage import get_state_store, GameStateConflict
+
 
 class Level(models.Model):
     """Round of play. Higher levels are more difficult."""
     levelno = models.IntegerField(validators=[MinValueValidator(1)])
 
+    DECK_TTL = 60  # seconds before a level's question pks are reloaded
+    _decks = {}  # level pk -> (time loaded, [question pks])
+
     def __unicode__(self):
         return u"Level %d" % self.levelno
 
+    @classmethod
+    def load_decks(cls):
+        """Cache the question pks of every level in this process."""
+        decks = {}
+        for level_pk, question_pk in Question.objects.values_list('level',
+                                                                  'pk'):
+            decks.setdefault(level_pk, []).append(question_pk)
+        now = time.time()
+        for level_pk, deck in decks.items():
+            cls._decks[level_pk] = (now, deck)
+        return decks
+
+    def question_deck(self):
+        loaded, deck = self._decks.get(self.pk, (None, None))
+        if deck is None or time.time() - loaded > self.DECK_TTL:
+            deck = list(self.question_set.values_list('pk', flat=True))
+            self._decks[self.pk] = (time.time(), deck)
+        return deck
+
     def random_question(self):
-        return self.question_set.order_by('?')[0]
+        deck = self.question_deck()
+        try:
+            return Question.objects.get(pk=random.choice(deck), level=self)
+        except (IndexError, Question.DoesNotExist):
+            # stale deck, fall back to picking in the database
+            self._decks.pop(self.pk, None)
+            return self.question_set.order_by('?')[0]
 
 
 class Question(models.Model):
@@ -81,12 +113,13 @@ class Game(models.Model):
         # expire old games
         for game in uncompleted[:-1]:
             game.complete = True
-            game.save()
+            get_state_store().flush(game)
         if uncompleted:
             current = uncompleted[-1]
-            if now - current.last_access > cls.MAX_AGE:
+            store = get_state_store()
+            if now - store.last_access(current) > cls.MAX_AGE:
                 current.complete = True
-                current.save()
+                store.flush(current)
             else:
                 return current
         if not create:
@@ -113,8 +146,33 @@ class Game(models.Model):
                             for pk in previous_winner_pks]
         return previous_winners
 
-    def get_state(self):
-        return GameState(self)
+    def get_state(self, store=None):
+        return GameState(self, store=store)
+
+
+class ProfilerConfig(models.Model):
+    """Admin switch for the request profiler (see mobigame.profiling)."""
+    enabled = models.BooleanField()
+    sample_rate = models.FloatField(default=0.01,
+        help_text="Fraction of requests to profile (0 to 1).")
+
+    def __unicode__(self):
+        return u"Profiler (%s, %g)" % ("on" if self.enabled else "off",
+                                       self.sample_rate)
+
+    @classmethod
+    def current(cls):
+        configs = list(cls.objects.all()[:1])
+        return configs[0] if configs else None
+
+
+class ReplicaHeartbeat(models.Model):
+    """Time of the last write seen by a read replica (see
+    mobigame.routers)."""
+    beat = models.DateTimeField()
+
+    def __unicode__(self):
+        return u"Replica heartbeat %s" % (self.beat,)
 
 
 class GameState(object):
@@ -131,16 +189,32 @@ class GameState(object):
         'winners': [],
         # players that have been eliminated
         'eliminated': [],
+        # player -> [level, time by which they must answer]
+        'deadlines': {},
+        # colour -> player that reserved it
+        'colours': {},
         }
+    ROUND_TIMEOUT = 30  # seconds each player has to answer a round
     PLAYER_STATE_START = {
         'level': 0,  # last level answered
         'questions': {},  # level -> question_pk, answer_pk
         }
 
-    def __init__(self, game):
+    SAVE_RETRIES = 10
+    # an unchanged state is still saved this often so that games that are
+    # only being polled don't expire (see Game.MAX_AGE)
+    TOUCH_INTERVAL = datetime.timedelta(seconds=30)
+
+    def __init__(self, game, store=None):
         self.game = game
-        if game.state:
-            self.data = json.loads(game.state)
+        self.store = store if store is not None else get_state_store()
+        self._load(self.store.load(game))
+
+    def _load(self, state):
+        # the serialized state this copy is based on, for save()
+        self._stored = state
+        if state:
+            self.data = json.loads(state)
         else:
             self.data = copy.deepcopy(self.GAME_STATE_START)
 
@@ -153,22 +227,74 @@ class GameState(object):
     def _pk(self, obj):
         return str(obj.pk)
 
+    def refresh(self):
+        """Reload the state as last saved by any request."""
+        self._load(self.store.fetch(self.game))
+
     def save(self):
-        self.game.state = json.dumps(self.data)
-        self.game.complete = len(self['eliminated']) == self.NUM_PLAYERS
-        if self.data['winners']:
-            player_pk = int(self.data['winners'][0])
-            winner = Player.objects.get(pk=player_pk)
-            self.game.winner = winner
-        else:
-            self.game.winner = None
-        self.game.save()
+        """Save the state unless another request saved since it was loaded.
+
+        Returns False, leaving the stored state alone, if one did. Use
+        update() to re-apply changes on top of theirs. An unchanged state
+        isn't written at all unless the game is due a TOUCH_INTERVAL
+        refresh.
+        """
+        # sorted, so that an unchanged state serializes the same way
+        state = json.dumps(self.data, sort_keys=True)
+        if state == self._stored and not self._touch_due():
+            return True
+        if not self.store.swap(self.game, self._stored, state):
+            return False
+        self._stored = state
+        complete = len(self['eliminated']) == self.NUM_PLAYERS
+        winner_id = int(self['winners'][0]) if self['winners'] else None
+        if (complete != self.game.complete or
+            winner_id != self.game.winner_id):
+            self.game.complete = complete
+            self.game.winner_id = winner_id
+            self.store.save(self.game)
+        return True
+
+    def _touch_due(self):
+        last_access = self.store.last_access(self.game)
+        return (last_access is None or
+                datetime.datetime.now() - last_access > self.TOUCH_INTERVAL)
+
+    def update(self, change):
+        """Apply change(self) and save, re-applying it to the latest state
+        whenever another request saved first. Returns change's result."""
+        for _ in range(self.SAVE_RETRIES):
+            result = change(self)
+            if self.save():
+                return result
+            self.refresh()
+        raise GameStateConflict("Couldn't save %s" % self.game)
 
     def colour_used(self, colour):
-        pks = [int(pk) for pk in self['players']]
-        used_colours = set(Player.objects.filter(pk__in=pks)\
-                                         .values_list('colour', flat=True))
-        return colour in used_colours
+        return colour in self.data.get('colours', {})
+
+    def free_colours(self):
+        return [colour for colour, _desc, _style in Player.COLOURS
+                if not self.colour_used(colour)]
+
+    def join(self, player, colour):
+        """Reserve colour for player and add them to the game.
+
+        The reservation is saved with update(), so two players can't take
+        the same colour at once and later saves can't undo it. Returns
+        False if the colour belongs to someone else.
+        """
+        player_pk = self._pk(player)
+
+        def reserve(gamestate):
+            colours = gamestate.data.setdefault('colours', {})
+            owner = colours.get(colour)
+            if owner is None:
+                colours[colour] = player_pk
+                gamestate.add_player(player)
+                return True
+            return owner == player_pk
+        return self.update(reserve)
 
     def add_player(self, player):
         defaults = copy.deepcopy(self.PLAYER_STATE_START)
@@ -200,8 +326,9 @@ class GameState(object):
     def winner(self, player):
         return self['winners'][0:1] == [self._pk(player)]
 
-    def answer(self, player, answer_pk):
-        """Answer for the current question."""
+    def answer(self, player, answer_pk, answer_question_pk, correct):
+        """Answer for the current question. Answers to any other question
+        are ignored."""
         player_state = self['players'][self._pk(player)]
         questions = player_state['questions']
         level_no = player_state['level']
@@ -209,16 +336,25 @@ class GameState(object):
         if level_key not in questions:
             return
         question_pk, existing_answer_pk = questions[level_key]
-        if existing_answer_pk is not None:
+        if existing_answer_pk is not None or self.eliminated(player):
             return
 
-        answer = Answer.objects.get(pk=answer_pk)
-        if answer.question.pk != question_pk:
+        if answer_question_pk != question_pk:
             return
 
         questions[level_key] = [question_pk, answer_pk]
+        self.advance(player, correct)
+
+    def advance(self, player, correct):
+        """Move player past the current level after answering.
+
+        Applies the round rules (wrong answers, ROUND_LIMITS and winning
+        the LAST_LEVEL) without touching the database.
+        """
+        player_state = self['players'][self._pk(player)]
+        level_no = player_state['level']
         player_state['level'] = min(level_no + 1, self.LAST_LEVEL)
-        if not answer.correct:
+        if not correct:
             self.eliminate_player(player)
         elif level_no == self.LAST_LEVEL:
             self['winners'].append(self._pk(player))
@@ -228,6 +364,51 @@ class GameState(object):
             if self.players_at_level(level_no + 1) >= limit:
                 self.eliminate_player(player)
 
+    def _deadlines(self):
+        return self.data.setdefault('deadlines', {})
+
+    def _pending_deadlines(self):
+        """Yield (player_pk, deadline) for players still holding a round."""
+        for player_pk, (level_no, deadline) in self._deadlines().items():
+            if player_pk in self['eliminated']:
+                continue
+            if self['players'][player_pk]['level'] != level_no:
+                continue
+            yield player_pk, deadline
+
+    def arm_timers(self, now=None):
+        """Start the clock for players who haven't finished the current
+        round yet."""
+        if not self.full():
+            return
+        if now is None:
+            now = time.time()
+        level_no = self.level_no()
+        deadlines = self._deadlines()
+        for player_pk, player_state in self['players'].items():
+            if player_pk in self['eliminated']:
+                continue
+            if player_state['level'] != level_no:
+                continue
+            deadline = deadlines.get(player_pk)
+            if deadline is None or deadline[0] != level_no:
+                deadlines[player_pk] = [level_no, now + self.ROUND_TIMEOUT]
+
+    def next_deadline(self):
+        """Earliest time a player will be timed out, or None."""
+        pending = [deadline for _pk, deadline in self._pending_deadlines()]
+        return min(pending) if pending else None
+
+    def expire_idle_players(self, now=None):
+        """Eliminate players who missed their deadline and return
+        their pks."""
+        if now is None:
+            now = time.time()
+        expired = [player_pk for player_pk, deadline
+                   in self._pending_deadlines() if deadline <= now]
+        self['eliminated'].extend(expired)
+        return expired
+
     def current_question(self, player):
         """Return the question for the current level, creating one
         if needed."""
@@ -279,13 +460,25 @@ class GameState(object):
     API_V1_LEVELS = ["1234", "5678", "9xyz"]
     API_V1_WINNER = "mnop"
 
+    def player_colours(self):
+        """Map player pks to colours, using the colour reservations and
+        only querying the Player table for players without one."""
+        colours = dict((player_pk, colour) for colour, player_pk
+                       in self.data.get('colours', {}).items())
+        missing = [int(pk) for pk in self['players'] if pk not in colours]
+        if missing:
+            for pk, colour in Player.objects.filter(pk__in=missing)\
+                                            .values_list('pk', 'colour'):
+                colours[str(pk)] = colour
+        return colours
+
     def api_v1_state(self):
+        colours = self.player_colours()
         # handle non-full game
         if not self.full():
             api_values = []
             for player_pk in self['players']:
-                player = Player.objects.get(pk=int(player_pk))
-                player_idx = self.API_V1_ORDER.index(player.colour)
+                player_idx = self.API_V1_ORDER.index(colours[player_pk])
                 api_values.append(self.API_V1_LEVELS[0][player_idx])
                 if not api_values:
                     return "0"
@@ -297,9 +490,8 @@ class GameState(object):
         if players_synced:
             level = max(level - 1, 0)
         for player_pk, player_state in self['players'].items():
-            player = Player.objects.get(pk=int(player_pk))
-            player_idx = self.API_V1_ORDER.index(player.colour)
-            if self.winner(player):
+            player_idx = self.API_V1_ORDER.index(colours[player_pk])
+            if self['winners'][0:1] == [player_pk]:
                 api_values.append(self.API_V1_WINNER[player_idx])
                 continue
             if player_pk in self['eliminated']:
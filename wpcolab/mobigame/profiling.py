@@ -0,0 +1,190 @@
+"""On-demand sampling profiler for live requests.
+
+ProfilingMiddleware profiles a request when either:
+
+* profiling is switched on in the admin (ProfilerConfig) and the request
+  is picked by its sample rate, or
+* the request carries a valid X-Mobigame-Profile header (see
+  sign_profile_header() and the enlightenment_profile_token command).
+
+While a request is profiled a wall-clock interval timer samples the Python
+stack. The samples are written in collapsed-stack format (one
+``frame;frame;frame count`` line per stack, as read by flamegraph.pl and
+speedscope) to MOBIGAME_PROFILE_DIR, and the time spent in GameState
+methods, the ORM and template rendering is logged.
+
+When profiling is off the only cost is a cached config lookup.
+"""
+
+import os
+import time
+import random
+import signal
+import logging
+import threading
+import collections
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from mobigame.models import GameState, ProfilerConfig
+
+
+logger = logging.getLogger('mobigame.profiling')
+
+PROFILE_HEADER = 'HTTP_X_MOBIGAME_PROFILE'
+PROFILE_SALT = 'mobigame.profiling'
+
+CONFIG_TTL = 5  # seconds between reloads of the admin switch
+SAMPLE_INTERVAL = 0.001  # seconds between stack samples
+
+
+def sign_profile_header(seconds=300):
+    """Return an X-Mobigame-Profile header value valid for seconds."""
+    expires = str(int(time.time() + seconds))
+    return "%s:%s" % (expires,
+                      salted_hmac(PROFILE_SALT, expires).hexdigest())
+
+
+def valid_profile_header(value):
+    expires, _, signature = value.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = salted_hmac(PROFILE_SALT, expires).hexdigest()
+    return constant_time_compare(signature, expected)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    obj = frame.f_locals.get('self') if code.co_argcount else None
+    if obj is not None:
+        return "%s.%s" % (type(obj).__name__, code.co_name)
+    module = frame.f_globals.get('__name__', code.co_filename)
+    return "%s.%s" % (module, code.co_name)
+
+
+def frame_category(frame):
+    """Which part of the stack a frame's time is attributed to."""
+    filename = frame.f_code.co_filename
+    if (frame.f_code.co_argcount and
+        isinstance(frame.f_locals.get('self'), GameState)):
+        return 'gamestate'
+    if os.sep.join(['django', 'db']) in filename:
+        return 'orm'
+    if os.sep.join(['django', 'template']) in filename:
+        return 'template'
+    return None
+
+
+class Sampler(object):
+    """Samples the stack of the current thread with SIGALRM.
+
+    Only works in the main thread (where signal handlers run), which is
+    where gunicorn's sync workers handle requests.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.categories = collections.Counter()
+        self.samples = 0
+        self._old_handler = None
+
+    @staticmethod
+    def available():
+        return isinstance(threading.current_thread(), threading._MainThread)
+
+    def _sample(self, signum, frame):
+        # a sample counts towards the innermost category on the stack, so
+        # ORM queries made by GameState are ORM time
+        names = []
+        category = None
+        while frame is not None:
+            names.append(frame_name(frame))
+            if category is None:
+                category = frame_category(frame)
+            frame = frame.f_back
+        names.reverse()
+        self.stacks[";".join(names)] += 1
+        self.categories[category or 'other'] += 1
+        self.samples += 1
+
+    def start(self):
+        self._old_handler = signal.signal(signal.SIGALRM, self._sample)
+        # restart (rather than fail) system calls interrupted by samples
+        signal.siginterrupt(signal.SIGALRM, False)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_REAL, 0, 0)
+        signal.signal(signal.SIGALRM, self._old_handler or signal.SIG_DFL)
+
+    def write_collapsed(self, path):
+        with open(path, "wb") as out:
+            for stack, count in sorted(self.stacks.items()):
+                out.write("%s %d\n" % (stack, count))
+
+    def summary(self):
+        return ", ".join("%s %.0f%%" % (category,
+                                         100.0 * count / self.samples)
+                         for category, count
+                         in self.categories.most_common())
+
+
+class ProfilingMiddleware(object):
+    """Profile a sample of requests (see module docstring)."""
+
+    def __init__(self):
+        self._config = None
+        self._config_loaded = 0
+
+    def sample_rate(self):
+        now = time.time()
+        if now - self._config_loaded > CONFIG_TTL:
+            self._config = ProfilerConfig.current()
+            self._config_loaded = now
+        config = self._config
+        if config is None or not config.enabled:
+            return 0
+        return config.sample_rate
+
+    def should_profile(self, request):
+        header = request.META.get(PROFILE_HEADER)
+        if header is not None:
+            return valid_profile_header(header)
+        rate = self.sample_rate()
+        return rate > 0 and random.random() < rate
+
+    def process_request(self, request):
+        if not self.should_profile(request) or not Sampler.available():
+            return None
+        request.mobigame_sampler = Sampler()
+        request.mobigame_sampler.start()
+        request.mobigame_profile_start = time.time()
+        return None
+
+    def process_response(self, request, response):
+        sampler = getattr(request, 'mobigame_sampler', None)
+        if sampler is None:
+            return response
+        sampler.stop()
+        elapsed = time.time() - request.mobigame_profile_start
+        del request.mobigame_sampler
+        if not sampler.samples:
+            return response
+
+        profile_dir = getattr(settings, 'MOBIGAME_PROFILE_DIR', 'logs')
+        view = request.path.strip('/').replace('/', '-') or 'index'
+        filename = "profile-%s-%d-%d.collapsed" % (
+            view, int(time.time() * 1000), os.getpid())
+        path = os.path.join(profile_dir, filename)
+        # a profile is never worth failing the player's request for
+        try:
+            sampler.write_collapsed(path)
+            logger.info("Profiled %s in %.3fs (%d samples: %s) -> %s" % (
+                request.path, elapsed, sampler.samples, sampler.summary(),
+                path))
+        except Exception:
+            logger.exception("Couldn't save the profile of %s to %s"
+                             % (request.path, path))
+        return response
@@ -0,0 +1,120 @@
+"""Database routing for read-only views.
+
+Views decorated with replica_reads (scores and the hardware API) read the
+mobigame tables from the MOBIGAME_REPLICA_DB alias so that they don't
+compete with game writes on the primary. The consistency rules are:
+
+* Writes always go to the primary ('default').
+* Only replica_reads views read from the replica, and only for mobigame
+  models (the replica sync doesn't copy sessions, auth and so on).
+  Everything else (in particular the play path) reads its own writes from
+  the primary.
+* Once a replica_reads view writes, the rest of that request reads from
+  the primary.
+* The replica is only used while it is less than MOBIGAME_REPLICA_MAX_LAG
+  seconds behind, judged by the ReplicaHeartbeat row that the sync job
+  (or a heartbeat job, for real replication) writes to the primary.
+  Otherwise, or if its heartbeat can't be read, reads fall back to the
+  primary.
+* If a query on the replica fails, the view is run again reading from
+  the primary, and the replica is left alone until the next lag check.
+"""
+
+import time
+import datetime
+import threading
+
+from django.conf import settings
+# django.db imports this module while it is being set up
+from django.db.utils import DatabaseError, DEFAULT_DB_ALIAS
+
+
+LAG_CHECK_TTL = 1  # seconds between replica lag checks
+
+_local = threading.local()
+_lag_check = {'checked': 0, 'fresh': False}
+
+
+def replica_alias():
+    """The replica alias, or None if there is no replica configured."""
+    alias = getattr(settings, 'MOBIGAME_REPLICA_DB', 'replica')
+    if alias in settings.DATABASES:
+        return alias
+    return None
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind the primary, or None if unknown."""
+    from mobigame.models import ReplicaHeartbeat
+    try:
+        beats = list(ReplicaHeartbeat.objects.using(alias)
+                     .values_list('beat', flat=True)[:1])
+    except DatabaseError:
+        return None
+    if not beats:
+        return None
+    lag = datetime.datetime.now() - beats[0]
+    return lag.days * 86400 + lag.seconds + lag.microseconds / 1e6
+
+
+def replica_fresh(alias):
+    """Whether the replica is within the lag tolerance (checked at most
+    once every LAG_CHECK_TTL seconds)."""
+    now = time.time()
+    if now - _lag_check['checked'] > LAG_CHECK_TTL:
+        lag = replica_lag(alias)
+        max_lag = getattr(settings, 'MOBIGAME_REPLICA_MAX_LAG', 5)
+        _lag_check['fresh'] = lag is not None and lag <= max_lag
+        _lag_check['checked'] = now
+    return _lag_check['fresh']
+
+
+def replica_failed():
+    """Stop using the replica until the next lag check."""
+    _lag_check['fresh'] = False
+    _lag_check['checked'] = time.time()
+
+
+def replica_reads(view):
+    """Let a read-only view read from the replica (see module docstring)."""
+    def wrapper(request, *args, **kw):
+        _local.replica_reads = True
+        _local.replica_used = False
+        try:
+            try:
+                return view(request, *args, **kw)
+            except DatabaseError:
+                # only retry if the replica was read and nothing written
+                if not (_local.replica_used and _local.replica_reads):
+                    raise
+            replica_failed()
+            _local.replica_reads = False
+            return view(request, *args, **kw)
+        finally:
+            _local.replica_reads = False
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+class ReplicaRouter(object):
+    """Send mobigame reads from replica_reads views to the replica."""
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_local, 'replica_reads', False):
+            return None
+        if model._meta.app_label != 'mobigame':
+            return None
+        alias = replica_alias()
+        if alias is not None and replica_fresh(alias):
+            _local.replica_used = True
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        # read your own writes for the rest of the request
+        _local.replica_reads = False
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
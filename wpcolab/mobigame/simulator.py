@@ -0,0 +1,166 @@
+"""Offline game simulator for tuning round limits and question mix.
+
+Games are played out with the same transition rules as GameState (via
+GameState.advance) but without the ORM, so millions of games can be run
+in a few minutes across several processes.
+"""
+
+import copy
+import random
+import collections
+import multiprocessing
+
+from mobigame.models import GameState
+
+
+SimulatedPlayer = collections.namedtuple('SimulatedPlayer', ['pk'])
+
+
+class SimulatedGameState(GameState):
+    """A GameState that lives entirely in memory."""
+
+    def __init__(self):
+        self.game = None
+        self.store = None
+        self.data = copy.deepcopy(self.GAME_STATE_START)
+
+    def save(self):
+        pass
+
+
+class SimulationStats(object):
+    """Aggregated results of a batch of simulated games."""
+
+    def __init__(self):
+        self.games = 0
+        self.wins = 0
+        # level -> number of players eliminated at that level
+        self.eliminations = collections.Counter()
+        # level -> how many of those missed the round deadline
+        self.timeouts = collections.Counter()
+        # level -> [total seconds, max seconds, number of rounds]
+        self.round_times = {}
+        self.game_time = 0.0
+
+    def add_round(self, level_no, duration):
+        total, longest, count = self.round_times.get(level_no, [0.0, 0.0, 0])
+        self.round_times[level_no] = [total + duration,
+                                      max(longest, duration), count + 1]
+
+    def merge(self, other):
+        self.games += other.games
+        self.wins += other.wins
+        self.eliminations.update(other.eliminations)
+        self.timeouts.update(other.timeouts)
+        for level_no, (total, longest, count) in other.round_times.items():
+            mine = self.round_times.setdefault(level_no, [0.0, 0.0, 0])
+            mine[0] += total
+            mine[1] = max(mine[1], longest)
+            mine[2] += count
+        self.game_time += other.game_time
+
+    def win_rate(self):
+        return float(self.wins) / self.games if self.games else 0.0
+
+    def print_report(self):
+        print "Games: %d" % self.games
+        print "Win rate: %.3f" % self.win_rate()
+        if self.games:
+            print "Mean game time: %.1fs" % (self.game_time / self.games)
+        print "Eliminations per game by level:"
+        for level_no in sorted(self.eliminations):
+            print "  Level %d: %.3f (%.3f timed out)" % (
+                level_no, float(self.eliminations[level_no]) / self.games,
+                float(self.timeouts[level_no]) / self.games)
+        print "Round times:"
+        for level_no in sorted(self.round_times):
+            total, longest, count = self.round_times[level_no]
+            print "  Level %d: mean %.1fs, max %.1fs (%d rounds)" % (
+                level_no, total / count, longest, count)
+
+
+def make_state_class(last_level=None, round_limits=None):
+    """Return a SimulatedGameState subclass with tuned rules."""
+    attrs = {}
+    if last_level is not None:
+        attrs['LAST_LEVEL'] = last_level
+    if round_limits is not None:
+        attrs['ROUND_LIMITS'] = round_limits
+    return type('TunedGameState', (SimulatedGameState,), attrs)
+
+
+def simulate_game(state_cls, accuracy, answer_time, rng, stats):
+    """Play one game, adding its results to stats.
+
+    accuracy maps level numbers to the chance of a correct answer and
+    answer_time is the mean number of seconds a player takes to answer.
+    Players slower than ROUND_TIMEOUT are eliminated, as the round timers
+    do, so no round lasts longer than that.
+    """
+    gamestate = state_cls()
+    players = [SimulatedPlayer(pk=i + 1)
+               for i in range(gamestate.NUM_PLAYERS)]
+    for player in players:
+        gamestate.add_player(player)
+        gamestate.seen_ready(player)
+
+    while len(gamestate['eliminated']) < gamestate.NUM_PLAYERS:
+        level_no = gamestate.level_no()
+        answers = sorted((rng.expovariate(1.0 / answer_time), player)
+                         for player in players
+                         if not gamestate.eliminated(player))
+        timeout = gamestate.ROUND_TIMEOUT
+        for seconds, player in answers:
+            if seconds > timeout:
+                gamestate.eliminate_player(player)
+                stats.eliminations[level_no] += 1
+                stats.timeouts[level_no] += 1
+                continue
+            gamestate.advance(player, rng.random() < accuracy[level_no])
+            if (gamestate.eliminated(player)
+                and not gamestate.winner(player)):
+                stats.eliminations[level_no] += 1
+        duration = min(answers[-1][0], timeout)
+        stats.add_round(level_no, duration)
+        stats.game_time += duration
+
+    stats.games += 1
+    if gamestate['winners']:
+        stats.wins += 1
+
+
+def simulate_batch(args):
+    """Simulate a batch of games. Used as a multiprocessing worker."""
+    games, seed, accuracy, answer_time, last_level, round_limits = args
+    state_cls = make_state_class(last_level, round_limits)
+    rng = random.Random(seed)
+    stats = SimulationStats()
+    for _ in xrange(games):
+        simulate_game(state_cls, accuracy, answer_time, rng, stats)
+    return stats
+
+
+def simulate(games, accuracy, answer_time=10.0, last_level=None,
+             round_limits=None, processes=None, batch_size=10000, seed=0):
+    """Simulate many games across processes and return merged stats."""
+    batches = []
+    remaining = games
+    while remaining > 0:
+        size = min(batch_size, remaining)
+        batches.append((size, seed + len(batches), accuracy, answer_time,
+                        last_level, round_limits))
+        remaining -= size
+
+    stats = SimulationStats()
+    if processes == 1:
+        results = map(simulate_batch, batches)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(simulate_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    for result in results:
+        stats.merge(result)
+    return stats
@@ -0,0 +1,225 @@
+"""Compact snapshots of the question bank.
+
+A snapshot is a gzip-compressed stream of JSON lines:
+
+* a header: {"format": "enlightenment-questions", "version": 1}
+* one columnar record per level:
+  {"level": 1, "questions": [text, ...], "answers": [[text, ...], ...],
+   "correct": [index of the correct answer, ...]}
+* a trailer with the number of levels, questions and answers and the
+  SHA-256 of all the level records.
+
+Loading streams the records, bulk inserts each level's questions and
+answers and only commits once the trailer's counts and checksum match.
+"""
+
+import gzip
+import json
+import zlib
+import hashlib
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from mobigame.models import Level, Question, Answer
+
+
+SNAPSHOT_FORMAT = 'enlightenment-questions'
+SNAPSHOT_VERSION = 1
+RECORD_KEYS = ('level', 'questions', 'answers', 'correct')
+
+
+class SnapshotError(Exception):
+    """Error reading a question bank snapshot."""
+
+
+def _dump(record):
+    return json.dumps(record, separators=(',', ':')) + "\n"
+
+
+def level_records():
+    """Yield a columnar record for each level."""
+    for level in Level.objects.order_by('levelno', 'pk'):
+        questions = list(level.question_set.order_by('pk')
+                         .values_list('pk', 'text'))
+        answers = dict((pk, []) for pk, _text in questions)
+        correct = dict((pk, None) for pk, _text in questions)
+        for question_pk, text, is_correct in Answer.objects\
+                .filter(question__level=level)\
+                .order_by('question', 'pk')\
+                .values_list('question', 'text', 'correct'):
+            if is_correct:
+                correct[question_pk] = len(answers[question_pk])
+            answers[question_pk].append(text)
+        yield {
+            'level': level.levelno,
+            'questions': [text for _pk, text in questions],
+            'answers': [answers[pk] for pk, _text in questions],
+            'correct': [correct[pk] for pk, _text in questions],
+            }
+
+
+def write_snapshot(fileobj):
+    """Write a snapshot of the question bank and return the trailer."""
+    out = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    checksum = hashlib.sha256()
+    trailer = {'levels': 0, 'questions': 0, 'answers': 0}
+    out.write(_dump({'format': SNAPSHOT_FORMAT,
+                     'version': SNAPSHOT_VERSION}))
+    for record in level_records():
+        line = _dump(record)
+        checksum.update(line)
+        out.write(line)
+        trailer['levels'] += 1
+        trailer['questions'] += len(record['questions'])
+        trailer['answers'] += sum(len(a) for a in record['answers'])
+    trailer['sha256'] = checksum.hexdigest()
+    out.write(_dump(trailer))
+    out.close()
+    return trailer
+
+
+def _read_lines(fileobj):
+    lines = iter(gzip.GzipFile(fileobj=fileobj, mode='rb'))
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        except (IOError, EOFError, zlib.error), e:
+            # not gzip, truncated or failing its CRC check
+            raise SnapshotError("Snapshot is corrupt: %s" % e)
+        yield line
+
+
+def _parse(line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise SnapshotError("Snapshot is corrupt: bad record")
+    if not isinstance(record, dict):
+        raise SnapshotError("Snapshot is corrupt: bad record")
+    return record
+
+
+def _check_record(record):
+    missing = [key for key in RECORD_KEYS if key not in record]
+    if missing:
+        raise SnapshotError("Snapshot record is missing %s"
+                            % ", ".join(missing))
+    columns = [record[key] for key in RECORD_KEYS[1:]]
+    if (not all(isinstance(column, list) for column in columns) or
+        len(set(len(column) for column in columns)) != 1 or
+        not all(isinstance(answers, list) for answers in record['answers'])):
+        raise SnapshotError("Snapshot record for level %r is malformed"
+                            % record['level'])
+
+
+def read_snapshot(fileobj):
+    """Yield the level records of a snapshot, checking the header, the
+    shape of each record and, once the last record has been read, the
+    trailer. Any problem raises SnapshotError."""
+    lines = _read_lines(fileobj)
+    try:
+        header = _parse(next(lines))
+    except (StopIteration, SnapshotError):
+        raise SnapshotError("Not a question bank snapshot")
+    if header.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError("Not a question bank snapshot")
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError("Unsupported snapshot version %r"
+                            % header.get('version'))
+
+    checksum = hashlib.sha256()
+    counts = {'levels': 0, 'questions': 0, 'answers': 0}
+    for line in lines:
+        record = _parse(line)
+        if 'sha256' in record:
+            trailer = record
+            break
+        _check_record(record)
+        checksum.update(line)
+        counts['levels'] += 1
+        counts['questions'] += len(record['questions'])
+        counts['answers'] += sum(len(a) for a in record['answers'])
+        yield record
+    else:
+        raise SnapshotError("Snapshot is truncated")
+
+    if checksum.hexdigest() != trailer['sha256']:
+        raise SnapshotError("Snapshot checksum mismatch")
+    for key, count in counts.items():
+        if trailer.get(key) != count:
+            raise SnapshotError("Snapshot has %d %s, expected %r"
+                                % (count, key, trailer.get(key)))
+
+
+def _insert_many(cursor, model, fields, rows):
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(name).column for name in fields]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join(qn(column) for column in columns),
+        ", ".join(["%s"] * len(columns)))
+    cursor.executemany(sql, rows)
+
+
+def _next_pk(model):
+    return (model.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0) + 1
+
+
+def _level(levelno):
+    # levelno isn't unique, so load into the oldest of any duplicates
+    levels = list(Level.objects.filter(levelno=levelno).order_by('pk')[:1])
+    if levels:
+        return levels[0]
+    return Level.objects.create(levelno=levelno)
+
+
+def load_snapshot(fileobj, replace=False):
+    """Load a snapshot into the question bank.
+
+    Questions are added to any existing ones unless replace is True (to
+    the oldest level with their level number, as levelno isn't unique).
+    Nothing is saved if the snapshot fails its integrity checks. Returns
+    the number of levels, questions and answers loaded.
+    """
+    counts = {'levels': 0, 'questions': 0, 'answers': 0}
+    with transaction.commit_on_success():
+        if replace:
+            Answer.objects.all().delete()
+            Question.objects.all().delete()
+            Level.objects.all().delete()
+        cursor = connection.cursor()
+        question_pk = _next_pk(Question)
+        answer_pk = _next_pk(Answer)
+
+        for record in read_snapshot(fileobj):
+            level = _level(record['level'])
+            question_rows = []
+            answer_rows = []
+            for text, answers, correct in zip(record['questions'],
+                                              record['answers'],
+                                              record['correct']):
+                question_rows.append((question_pk, text, level.pk))
+                for idx, answer_text in enumerate(answers):
+                    answer_rows.append((answer_pk, answer_text,
+                                        idx == correct, question_pk))
+                    answer_pk += 1
+                question_pk += 1
+            _insert_many(cursor, Question, ['id', 'text', 'level'],
+                         question_rows)
+            _insert_many(cursor, Answer, ['id', 'text', 'correct',
+                                          'question'], answer_rows)
+            # raw inserts, so tell the transaction to commit or roll back
+            transaction.set_dirty()
+            counts['levels'] += 1
+            counts['questions'] += len(question_rows)
+            counts['answers'] += len(answer_rows)
+
+        # explicit pks were inserted, so move the sequences past them
+        for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                     [Question, Answer]):
+            cursor.execute(sql)
+    return counts
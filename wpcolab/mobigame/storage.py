@@ -0,0 +1,250 @@
+"""Storage backends for live game state.
+
+A live game is short-lived, hot data so the JSON-encoded state can be kept
+out of the database while the game is running. Completed (or expired) games
+are always flushed back to ``Game.state`` so that scores and the admin see
+them.
+
+The backend is selected with the ``MOBIGAME_STATE_STORE`` setting, a dotted
+path to a ``StateStore`` subclass. The default keeps the original behaviour
+of writing every change straight to the database.
+"""
+
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+DEFAULT_STATE_STORE = 'mobigame.storage.DatabaseStateStore'
+
+
+class GameStateConflict(Exception):
+    """The game state couldn't be saved: it kept changing under the
+    request trying to save it, or the store stayed locked."""
+
+
+class StateStore(object):
+    """Base class for game state storage backends."""
+
+    def load(self, game):
+        """Return the serialized state for game (may be empty)."""
+        raise NotImplementedError
+
+    def fetch(self, game):
+        """Like load, but re-read from the backing store so that changes
+        saved by other requests are seen."""
+        return self.load(game)
+
+    def save(self, game):
+        """Record game.complete and game.winner, flushing the game if it
+        is complete. The state itself is only written by swap()."""
+        raise NotImplementedError
+
+    def flush(self, game):
+        """Write the current state of game to the database."""
+        raise NotImplementedError
+
+    def swap(self, game, old, new):
+        """Atomically replace the serialized state of game with new if it
+        is still old. Returns whether the state was replaced, or raises
+        GameStateConflict if the state can't be locked."""
+        raise NotImplementedError
+
+    def last_access(self, game):
+        """Return the time game was last saved."""
+        return game.last_access
+
+
+class DatabaseStateStore(StateStore):
+    """Store game state in the ``Game.state`` database column."""
+
+    def load(self, game):
+        return game.state
+
+    def fetch(self, game):
+        states = list(game.__class__._default_manager.filter(pk=game.pk)
+                      .values_list('state', flat=True))
+        if states:
+            game.state = states[0]
+        return game.state
+
+    def save(self, game):
+        # only the other columns; saving the whole row could overwrite a
+        # state swapped in by another request
+        game.__class__._default_manager.filter(pk=game.pk)\
+            .update(complete=game.complete, winner=game.winner_id)
+
+    def flush(self, game):
+        self.save(game)
+
+    def swap(self, game, old, new):
+        now = datetime.datetime.now()
+        updated = game.__class__._default_manager\
+                      .filter(pk=game.pk, state=old)\
+                      .update(state=new, last_access=now)
+        if updated:
+            game.state = new
+            game.last_access = now
+        return bool(updated)
+
+
+class KeyValueStateStore(StateStore):
+    """Base class for stores that keep live state in a key-value store.
+
+    Entries are (state, last_access) tuples keyed by game pk. Subclasses
+    implement _get, _set, _delete and _locked.
+    """
+
+    KEY_PREFIX = 'mobigame:state:'
+
+    def _key(self, game):
+        return "%s%s" % (self.KEY_PREFIX, game.pk)
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, entry):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _locked(self, key):
+        """Context manager holding an exclusive lock on key."""
+        raise NotImplementedError
+
+    def load(self, game):
+        entry = self._get(self._key(game))
+        if entry is None:
+            return game.state
+        return entry[0]
+
+    def save(self, game):
+        if game.complete:
+            self.flush(game)
+
+    def flush(self, game):
+        game.state = self.load(game)
+        game.save()
+        self._delete(self._key(game))
+
+    def swap(self, game, old, new):
+        key = self._key(game)
+        with self._locked(key):
+            if self.load(game) != old:
+                return False
+            self._set(key, (new, datetime.datetime.now()))
+        return True
+
+    def last_access(self, game):
+        entry = self._get(self._key(game))
+        if entry is None or game.last_access is None:
+            return game.last_access
+        return max(entry[1], game.last_access)
+
+
+class MemoryStateStore(KeyValueStateStore):
+    """Process-local state store. Only safe with a single worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._entries = {}
+
+    def _get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def _set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+
+    def _delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    @contextmanager
+    def _locked(self, key):
+        with self._swap_lock:
+            yield
+
+
+class CacheStateStore(KeyValueStateStore):
+    """State store backed by a Django cache shared between workers.
+
+    Point ``MOBIGAME_STATE_CACHE`` at a cache on the local host (e.g.
+    memcached listening on ``unix:/tmp/memcached.sock``) so that all the
+    gunicorn workers on a box see the same live games. A process-local
+    cache is refused, as the other workers and the round timers couldn't
+    see its games.
+    """
+
+    TIMEOUT = 60 * 60
+    LOCK_TIMEOUT = 5
+
+    def __init__(self, cache=None):
+        if cache is None:
+            backend = getattr(settings, 'MOBIGAME_STATE_CACHE', 'default')
+            cache = get_cache(backend)
+            if isinstance(cache, LocMemCache):
+                raise ImproperlyConfigured(
+                    "MOBIGAME_STATE_CACHE %r is local to each process; "
+                    "use a cache shared between workers" % backend)
+        self._cache = cache
+
+    def _get(self, key):
+        return self._cache.get(key)
+
+    def _set(self, key, entry):
+        self._cache.set(key, entry, self.TIMEOUT)
+
+    def _delete(self, key):
+        self._cache.delete(key)
+
+    @contextmanager
+    def _locked(self, key):
+        # cache.add() is atomic, so it doubles as a mutex between workers.
+        # A lock left by a dead worker expires after LOCK_TIMEOUT, so give
+        # up after that long: add() also fails while the cache is down.
+        lock_key = key + ':lock'
+        give_up = time.time() + self.LOCK_TIMEOUT
+        while not self._cache.add(lock_key, 1, self.LOCK_TIMEOUT):
+            if time.time() > give_up:
+                raise GameStateConflict("Timed out waiting for %s"
+                                        % lock_key)
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            self._cache.delete(lock_key)
+
+
+_state_store = None
+
+
+def load_state_store(path):
+    """Instantiate the StateStore subclass at the given dotted path."""
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        module = import_module(module_name)
+        store_cls = getattr(module, class_name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured("Error loading state store %r: %s"
+                                   % (path, e))
+    return store_cls()
+
+
+def get_state_store():
+    """Return the configured StateStore (created on first use)."""
+    global _state_store
+    if _state_store is None:
+        path = getattr(settings, 'MOBIGAME_STATE_STORE', DEFAULT_STATE_STORE)
+        _state_store = load_state_store(path)
+    return _state_store
@@ -5,7 +5,43 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import re
+import datetime
+import time
+import gzip
+import shutil
+import tempfile
+from StringIO import StringIO
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, DatabaseError
+from django.contrib.sessions.models import Session
+
+from mobigame.models import (Level, Question, Answer, Game, Player,
+                             ProfilerConfig, ReplicaHeartbeat)
+from mobigame.views import answer_cache
+from mobigame.snapshot import (SnapshotError, write_snapshot,
+                               load_snapshot)
+from mobigame.routers import ReplicaRouter, replica_reads, _lag_check
+from mobigame.management.commands.enlightenment_sync_replica import (
+    sync_replica)
+from mobigame.profiling import (Sampler, ProfilingMiddleware,
+                                sign_profile_header, valid_profile_header)
+from mobigame.storage import (DatabaseStateStore, MemoryStateStore,
+                              CacheStateStore, GameStateConflict)
+from mobigame.simulator import (SimulationStats, make_state_class,
+                                simulate_game, simulate)
+from mobigame.timers import RoundTimers, expire_game
+from mobigame import warmup
+from mobigame.warmup import warm_up
+from mobigame.loaders import CachedLoader
 
 
 class SimpleTest(TestCase):
@@ -14,3 +50,711 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class StateStoreMixin(object):
+    """Conformance tests run against every state store."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.game = Game.objects.create(complete=False)
+        self.players = [Player.objects.create(first_name="Player %d" % i,
+                                              colour=colour)
+                        for i, (colour, _d, _s) in enumerate(Player.COLOURS)]
+
+    def reload(self):
+        return Game.objects.get(pk=self.game.pk)
+
+    def test_empty_state(self):
+        gamestate = self.game.get_state(store=self.store)
+        self.assertEqual(gamestate['players'], {})
+
+    def test_save_and_load(self):
+        gamestate = self.game.get_state(store=self.store)
+        gamestate.add_player(self.players[0])
+        gamestate.save()
+        gamestate = self.reload().get_state(store=self.store)
+        self.assertTrue(gamestate.player_exists(self.players[0]))
+
+    def test_complete_game_flushed(self):
+        gamestate = self.game.get_state(store=self.store)
+        for player in self.players:
+            gamestate.add_player(player)
+            gamestate.eliminate_player(player)
+        gamestate.save()
+        game = self.reload()
+        self.assertTrue(game.complete)
+        gamestate = game.get_state(store=DatabaseStateStore())
+        self.assertEqual(len(gamestate['eliminated']), 4)
+
+    def test_flush(self):
+        gamestate = self.game.get_state(store=self.store)
+        gamestate.add_player(self.players[0])
+        gamestate.save()
+        self.store.flush(self.game)
+        gamestate = self.reload().get_state(store=DatabaseStateStore())
+        self.assertTrue(gamestate.player_exists(self.players[0]))
+
+    def test_join(self):
+        gamestate = self.game.get_state(store=self.store)
+        self.assertTrue(gamestate.join(self.players[0], 'red'))
+        self.assertTrue(gamestate.join(self.players[0], 'red'))
+        self.assertFalse(gamestate.join(self.players[1], 'red'))
+        gamestate = self.game.get_state(store=self.store)
+        self.assertTrue(gamestate.colour_used('red'))
+        self.assertTrue(gamestate.player_exists(self.players[0]))
+        self.assertFalse(gamestate.player_exists(self.players[1]))
+        self.assertEqual(gamestate.free_colours(), ['blue', 'green', 'pink'])
+
+    def test_stale_swap(self):
+        gamestate = self.game.get_state(store=self.store)
+        old = self.store.load(self.game)
+        gamestate.join(self.players[0], 'red')
+        self.assertFalse(self.store.swap(self.game, old, '{}'))
+
+    def test_last_access(self):
+        gamestate = self.game.get_state(store=self.store)
+        gamestate.save()
+        self.assertTrue(self.store.last_access(self.game) >=
+                        self.reload().last_access)
+
+
+class ConcurrentJoinMixin(object):
+    """Many players logging in at once never share a colour."""
+
+    def stale_games(self, count):
+        """Separate instances of the game, as concurrent requests see it."""
+        return [Game.objects.get(pk=self.game.pk) for _ in range(count)]
+
+    def test_stale_join(self):
+        first, second, third = self.stale_games(3)
+        self.assertTrue(first.get_state(store=self.store)
+                        .join(self.players[0], 'red'))
+        self.assertTrue(second.get_state(store=self.store)
+                        .join(self.players[1], 'blue'))
+        self.assertFalse(third.get_state(store=self.store)
+                         .join(self.players[2], 'red'))
+        gamestate = self.reload().get_state(store=self.store)
+        self.assertEqual(gamestate['colours'],
+                         {'red': str(self.players[0].pk),
+                          'blue': str(self.players[1].pk)})
+
+    def test_stale_save(self):
+        poll, login = self.stale_games(2)
+        polled = poll.get_state(store=self.store)
+        self.assertTrue(login.get_state(store=self.store)
+                        .join(self.players[0], 'red'))
+        # a request that loaded the state before the join mustn't undo it
+        polled.add_player(self.players[1])
+        self.assertFalse(polled.save())
+        # update() re-applies the change on top of the join
+        polled.update(lambda gamestate: gamestate.add_player(self.players[1]))
+        gamestate = self.reload().get_state(store=self.store)
+        self.assertEqual(gamestate['colours'],
+                         {'red': str(self.players[0].pk)})
+        self.assertEqual(sorted(gamestate['players'].keys()),
+                         sorted(str(p.pk) for p in self.players[:2]))
+
+    def test_unchanged_not_written(self):
+        poll, login = self.stale_games(2)
+        polled = poll.get_state(store=self.store)
+        polled.save()
+        self.assertTrue(login.get_state(store=self.store)
+                        .join(self.players[0], 'red'))
+        # nothing to write, so nothing to conflict with
+        self.assertTrue(polled.save())
+        self.assertFalse(polled.update(lambda gamestate: gamestate.full()))
+        # except to keep the game from expiring
+        polled.TOUCH_INTERVAL = datetime.timedelta(0)
+        self.assertFalse(polled.save())
+        gamestate = self.reload().get_state(store=self.store)
+        self.assertEqual(gamestate['colours'],
+                         {'red': str(self.players[0].pk)})
+
+    def test_concurrent_join(self):
+        if (isinstance(self.store, DatabaseStateStore) and
+            connection.settings_dict['NAME'] == ':memory:'):
+            self.skipTest("threads can't share an in-memory SQLite database")
+        players = [Player.objects.create(first_name="Crowd %d" % i,
+                                         colour='red')
+                   for i in range(20)]
+        games = self.stale_games(len(players))
+        winners = []
+
+        def login(game, player):
+            try:
+                if game.get_state(store=self.store).join(player, 'red'):
+                    winners.append(player)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=login, args=(game, player))
+                   for game, player in zip(games, players)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(winners), 1)
+        gamestate = self.reload().get_state(store=self.store)
+        self.assertEqual(gamestate['players'].keys(), [str(winners[0].pk)])
+
+
+class DatabaseStateStoreTest(ConcurrentJoinMixin, StateStoreMixin,
+                             TransactionTestCase):
+    # real transactions, so that logins on other threads see the game
+    def make_store(self):
+        return DatabaseStateStore()
+
+
+class MemoryStateStoreTest(ConcurrentJoinMixin, StateStoreMixin, TestCase):
+    def make_store(self):
+        return MemoryStateStore()
+
+    def test_live_state_not_written(self):
+        gamestate = self.game.get_state(store=self.store)
+        gamestate.add_player(self.players[0])
+        gamestate.save()
+        self.assertEqual(self.reload().state, '')
+
+
+class CacheStateStoreTest(ConcurrentJoinMixin, StateStoreMixin, TestCase):
+    def make_store(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        cache.clear()
+        return CacheStateStore(cache)
+
+    def test_lock_timeout(self):
+        # add() fails like this while memcached is down, too
+        self.store.LOCK_TIMEOUT = 0.05
+        self.store._cache.add(self.store._key(self.game) + ':lock', 1)
+        self.assertRaises(GameStateConflict, self.store.swap,
+                          self.game, '', '{}')
+
+    def test_local_cache_refused(self):
+        old_cache = settings.MOBIGAME_STATE_CACHE
+        settings.MOBIGAME_STATE_CACHE = 'default'
+        try:
+            self.assertRaises(ImproperlyConfigured, CacheStateStore)
+        finally:
+            settings.MOBIGAME_STATE_CACHE = old_cache
+
+
+class SimulatorTest(TestCase):
+    def simulate_one(self, accuracy, **rules):
+        import random
+        stats = SimulationStats()
+        simulate_game(make_state_class(**rules), accuracy, 10.0,
+                      random.Random(1), stats)
+        return stats
+
+    def test_all_correct(self):
+        stats = self.simulate_one({1: 1.0, 2: 1.0, 3: 1.0})
+        self.assertEqual(stats.games, 1)
+        self.assertEqual(stats.wins, 1)
+        self.assertEqual(stats.eliminations, {1: 2, 2: 1})
+        self.assertEqual(sorted(stats.round_times), [1, 2, 3])
+
+    def test_all_wrong(self):
+        stats = self.simulate_one({1: 0.0})
+        self.assertEqual(stats.wins, 0)
+        self.assertEqual(stats.eliminations, {1: 4})
+
+    def test_tuned_rules(self):
+        stats = self.simulate_one({1: 1.0, 2: 1.0}, last_level=2,
+                                  round_limits={1: 4})
+        self.assertEqual(stats.wins, 1)
+        self.assertEqual(stats.eliminations, {1: 1, 2: 2})
+
+    def test_round_timeout(self):
+        import random
+        stats = SimulationStats()
+        state_cls = make_state_class()
+        rng = random.Random(1)
+        for _ in range(20):
+            simulate_game(state_cls, {1: 1.0, 2: 1.0, 3: 1.0}, 1000.0, rng,
+                          stats)
+        # nearly everyone is too slow and none of them finish
+        self.assertTrue(stats.timeouts[1] > 70)
+        self.assertTrue(stats.wins < 5)
+        for total, longest, count in stats.round_times.values():
+            self.assertTrue(longest <= state_cls.ROUND_TIMEOUT)
+
+    def test_simulate_batches(self):
+        stats = simulate(25, {1: 0.5, 2: 0.5, 3: 0.5}, processes=1,
+                         batch_size=10)
+        self.assertEqual(stats.games, 25)
+        self.assertTrue(0 <= stats.win_rate() <= 1)
+
+
+class RoundTimersTest(TestCase):
+    def setUp(self):
+        self.game = Game.objects.create(complete=False)
+        self.players = [Player.objects.create(first_name="Player %d" % i,
+                                              colour=colour)
+                        for i, (colour, _d, _s) in enumerate(Player.COLOURS)]
+        self.gamestate = self.game.get_state(store=DatabaseStateStore())
+        for player in self.players:
+            self.gamestate.add_player(player)
+            self.gamestate.seen_ready(player)
+
+    def test_arm_only_waits_on_current_round(self):
+        self.gamestate.advance(self.players[0], True)
+        self.gamestate.arm_timers(now=100)
+        self.assertEqual(self.gamestate.next_deadline(),
+                         100 + self.gamestate.ROUND_TIMEOUT)
+        expired = self.gamestate.expire_idle_players(now=1000)
+        self.assertEqual(sorted(expired),
+                         sorted(str(p.pk) for p in self.players[1:]))
+        self.assertFalse(self.gamestate.eliminated(self.players[0]))
+
+    def test_answering_clears_deadline(self):
+        self.gamestate.arm_timers(now=100)
+        for player in self.players:
+            self.gamestate.advance(player, True)
+        self.assertEqual(self.gamestate.next_deadline(), None)
+        self.assertEqual(self.gamestate.expire_idle_players(now=1000), [])
+
+    def test_expire_game_starts_next_round(self):
+        self.gamestate.advance(self.players[0], True)
+        self.gamestate.arm_timers(now=100)
+        self.gamestate.save()
+        expired, deadline = expire_game(self.game, 1000)
+        self.assertEqual(len(expired), 3)
+        self.assertEqual(deadline, 1000 + self.gamestate.ROUND_TIMEOUT)
+
+    def test_expire_game_keeps_late_answer(self):
+        self.gamestate.arm_timers(now=100)
+        self.gamestate.save()
+        stale = Game.objects.get(pk=self.game.pk)
+        self.gamestate.update(
+            lambda gamestate: gamestate.advance(self.players[0], True))
+        expired, _deadline = expire_game(stale, 1000)
+        self.assertEqual(sorted(expired),
+                         sorted(str(p.pk) for p in self.players[1:]))
+        gamestate = Game.objects.get(pk=self.game.pk).get_state()
+        self.assertFalse(gamestate.eliminated(self.players[0]))
+        self.assertEqual(gamestate.player_level(self.players[0]), 2)
+
+    def test_expire_game_not_due(self):
+        self.gamestate.arm_timers(now=100)
+        self.gamestate.save()
+        expired, deadline = expire_game(self.game, 110)
+        self.assertEqual(expired, [])
+        self.assertEqual(deadline, 100 + self.gamestate.ROUND_TIMEOUT)
+
+    def test_heap_order(self):
+        timers = RoundTimers()
+        timers.schedule(1, 30)
+        timers.schedule(2, 10)
+        timers.schedule(3, 20)
+        timers.schedule(2, 40)  # rescheduled
+        timers.schedule(3, None)  # cancelled
+        self.assertEqual(len(timers), 2)
+        self.assertEqual(timers.next_deadline(), 30)
+        self.assertEqual(timers.pop_due(35), [1])
+        self.assertEqual(timers.pop_due(50), [2])
+        self.assertEqual(timers.next_deadline(), None)
+
+
+class WarmUpTest(TestCase):
+    def setUp(self):
+        self.level = Level.objects.create(levelno=1)
+        self.questions = [Question.objects.create(text="Q%d" % i,
+                                                  level=self.level)
+                          for i in range(3)]
+
+    def test_warm_up(self):
+        timings = warm_up()
+        self.assertEqual([name for name, _seconds in timings],
+                         ['urls', 'question decks', 'templates'])
+        self.assertEqual(sorted(self.level.question_deck()),
+                         sorted(q.pk for q in self.questions))
+
+    def test_failing_stage_logged(self):
+        class Log(object):
+            def __init__(self):
+                self.errors = []
+                self.infos = []
+
+            def exception(self, msg):
+                self.errors.append(msg)
+
+            def info(self, msg):
+                self.infos.append(msg)
+
+        class Worker(object):
+            log = Log()
+
+        def broken():
+            raise RuntimeError("no database")
+
+        stages = warmup.STAGES
+        warmup.STAGES = [('broken', broken)] + stages
+        try:
+            self.assertRaises(RuntimeError, warm_up)
+            worker = Worker()
+            warmup.post_fork(None, worker)
+        finally:
+            warmup.STAGES = stages
+        self.assertEqual(worker.log.errors,
+                         ["Warm-up stage 'broken' failed"])
+        self.assertEqual(len(worker.log.infos), 1)
+        self.assertEqual(sorted(self.level.question_deck()),
+                         sorted(q.pk for q in self.questions))
+
+    def test_cached_loader_follows_debug(self):
+        loader = CachedLoader(
+            ['django.template.loaders.app_directories.Loader'])
+        debug = settings.DEBUG
+        try:
+            settings.DEBUG = False
+            template, _origin = loader.load_template('play.html')
+            self.assertTrue(loader.load_template('play.html')[0] is template)
+            settings.DEBUG = True
+            self.assertFalse(loader.load_template('play.html')[0] is template)
+        finally:
+            settings.DEBUG = debug
+
+    def test_random_question_from_deck(self):
+        Level.load_decks()
+        question = self.level.random_question()
+        self.assertTrue(question in self.questions)
+
+    def test_stale_deck(self):
+        Level.load_decks()
+        for question in self.questions[1:]:
+            question.delete()
+        for _ in range(5):
+            self.assertEqual(self.level.random_question(), self.questions[0])
+
+
+class LoginTest(TestCase):
+    def login(self, first_name, colour=''):
+        return self.client.post('/login/', {'first_name': first_name,
+                                            'colour': colour})
+
+    def test_login_colours(self):
+        self.assertEqual(self.login('alice', 'red').status_code, 302)
+        response = self.login('bob', 'red')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Red already taken!')
+
+    def test_auto_assign(self):
+        for i in range(4):
+            self.assertEqual(self.login('player %d' % i).status_code, 302)
+        self.assertContains(self.login('late'), 'All colours taken!')
+        gamestate = Game.current_game().get_state()
+        self.assertEqual(gamestate.free_colours(), [])
+
+    def test_api_v1_colours(self):
+        self.login('alice', 'red')
+        response = self.client.get('/api/v1/')
+        self.assertEqual(response.content, '2')  # red at level 1
+
+
+class IdempotentAnswerTest(TestCase):
+    def setUp(self):
+        answer_cache().clear()
+        level = Level.objects.create(levelno=1)
+        question = Question.objects.create(text="1 + 1?", level=level)
+        self.right = Answer.objects.create(text="2", correct=True,
+                                           question=question)
+        Answer.objects.create(text="3", correct=False, question=question)
+        self.clients = []
+        for colour, _desc, _style in Player.COLOURS:
+            client = Client()
+            client.post('/login/', {'first_name': colour, 'colour': colour})
+            self.clients.append(client)
+        for client in self.clients:
+            client.get('/play/')  # get ready
+        self.client = self.clients[0]
+
+    def question_token(self):
+        response = self.client.get('/play/')
+        return re.search(r'name="token" value="([0-9a-f]+)"',
+                         response.content).group(1)
+
+    def test_retry_replayed(self):
+        data = {'answer': self.right.pk, 'token': self.question_token()}
+        first = self.client.post('/play/', data)
+        self.assertEqual(first.status_code, 200)
+        # change the game behind the player's back; a replay won't see it
+        game = Game.current_game()
+        gamestate = game.get_state()
+        gamestate['eliminated'] = list(gamestate['players'])
+        gamestate.save()
+        retry = self.client.post('/play/', data)
+        self.assertEqual(retry.content, first.content)
+
+    def test_retry_skips_lookup(self):
+        data = {'answer': self.right.pk, 'token': self.question_token()}
+        first = self.client.post('/play/', data)
+        # replayed from the cache without looking the answer up again
+        Answer.objects.filter(pk=self.right.pk).delete()
+        retry = self.client.post('/play/', data)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.content, first.content)
+
+    def test_finishers_polling(self):
+        gamestate = Game.current_game().get_state()
+        players = sorted(gamestate['players'],
+                         key=lambda pk: Player.objects.get(pk=pk).colour)
+        # blue won, green came second
+        gamestate['winners'] = [players[0], players[1]]
+        gamestate['eliminated'] = players[:2]
+        gamestate.save()
+        templates = {}
+        for client in self.clients:
+            response = client.get('/play/')
+            colour = client.session['player'].colour
+            templates[colour] = response.templates[0].name
+        self.assertEqual(templates, {'blue': 'winner.html',
+                                     'green': 'second.html',
+                                     'pink': 'play.html',
+                                     'red': 'play.html'})
+
+    def test_malformed(self):
+        self.question_token()
+        for data in [{}, {'answer': ''}, {'answer': 'x'},
+                     {'answer': '999999'}]:
+            response = self.client.post('/play/', data)
+            self.assertEqual(response.status_code, 400)
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.old_profile_dir = settings.MOBIGAME_PROFILE_DIR
+        settings.MOBIGAME_PROFILE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.MOBIGAME_PROFILE_DIR)
+        settings.MOBIGAME_PROFILE_DIR = self.old_profile_dir
+
+    def busy(self, seconds=0.05):
+        end = time.time() + seconds
+        while time.time() < end:
+            pass
+
+    def test_header(self):
+        self.assertTrue(valid_profile_header(sign_profile_header()))
+        self.assertFalse(valid_profile_header(sign_profile_header(-10)))
+        self.assertFalse(valid_profile_header("9999999999:bad"))
+        self.assertFalse(valid_profile_header("garbage"))
+
+    def test_sampler(self):
+        sampler = Sampler()
+        sampler.start()
+        try:
+            self.busy()
+        finally:
+            sampler.stop()
+        self.assertTrue(sampler.samples > 0)
+        self.assertTrue(any('ProfilingTest.busy' in stack
+                            for stack in sampler.stacks))
+
+    def profile(self, **headers):
+        middleware = ProfilingMiddleware()
+        request = RequestFactory().get('/play/', **headers)
+        middleware.process_request(request)
+        self.busy()
+        middleware.process_response(request, HttpResponse())
+        return os.listdir(settings.MOBIGAME_PROFILE_DIR)
+
+    def test_off(self):
+        self.assertEqual(self.profile(), [])
+
+    def test_signed_header(self):
+        files = self.profile(HTTP_X_MOBIGAME_PROFILE=sign_profile_header())
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('profile-play-'))
+
+    def test_admin_switch(self):
+        ProfilerConfig.objects.create(enabled=True, sample_rate=1.0)
+        self.assertEqual(len(self.profile()), 1)
+
+    def test_unwritable_profile_dir(self):
+        middleware = ProfilingMiddleware()
+        request = RequestFactory().get(
+            '/play/', HTTP_X_MOBIGAME_PROFILE=sign_profile_header())
+        response = HttpResponse()
+        profile_dir = settings.MOBIGAME_PROFILE_DIR
+        settings.MOBIGAME_PROFILE_DIR = os.path.join(profile_dir, 'missing')
+        try:
+            middleware.process_request(request)
+            self.busy()
+            self.assertTrue(middleware.process_response(request, response)
+                            is response)
+        finally:
+            settings.MOBIGAME_PROFILE_DIR = profile_dir
+
+
+class ReplicaRouterTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        _lag_check['checked'] = 0
+        self.router = ReplicaRouter()
+
+    def read_db(self):
+        @replica_reads
+        def view(request):
+            return self.router.db_for_read(Game)
+        return view(None)
+
+    def test_no_heartbeat(self):
+        self.assertEqual(self.read_db(), None)
+
+    def test_synced(self):
+        Game.objects.create(complete=True)
+        sync_replica('replica')
+        self.assertEqual(self.read_db(), 'replica')
+        self.assertEqual(Game.objects.using('replica').count(), 1)
+        # other views keep reading from the primary
+        self.assertEqual(self.router.db_for_read(Game), None)
+
+    def test_lagging(self):
+        sync_replica('replica')
+        ReplicaHeartbeat.objects.using('replica').update(
+            beat=datetime.datetime.now() - datetime.timedelta(minutes=5))
+        self.assertEqual(self.read_db(), None)
+
+    def test_read_after_write(self):
+        sync_replica('replica')
+
+        @replica_reads
+        def view(request):
+            before = self.router.db_for_read(Game)
+            write = self.router.db_for_write(Game)
+            return before, write, self.router.db_for_read(Game)
+        self.assertEqual(view(None), ('replica', 'default', None))
+
+    def test_only_mobigame_models(self):
+        sync_replica('replica')
+
+        @replica_reads
+        def view(request):
+            return (self.router.db_for_read(Game),
+                    self.router.db_for_read(Session))
+        self.assertEqual(view(None), ('replica', None))
+
+    def test_replica_error_falls_back(self):
+        sync_replica('replica')
+        reads = []
+
+        @replica_reads
+        def view(request):
+            alias = self.router.db_for_read(Game)
+            reads.append(alias)
+            if alias == 'replica':
+                raise DatabaseError("replica went away")
+            return alias
+        self.assertEqual(view(None), None)
+        self.assertEqual(reads, ['replica', None])
+        # left alone until the next lag check
+        self.assertEqual(self.read_db(), None)
+
+    def test_sync_keeps_last_access(self):
+        game = Game.objects.create(complete=True)
+        Game.objects.filter(pk=game.pk).update(
+            last_access=datetime.datetime(2011, 1, 1))
+        sync_replica('replica')
+        copy = Game.objects.using('replica').get(pk=game.pk)
+        self.assertEqual(copy.last_access, datetime.datetime(2011, 1, 1))
+
+    def test_scores_from_replica(self):
+        winner = Player.objects.create(first_name="alice", colour="red")
+        Game.objects.create(complete=True, winner=winner)
+        sync_replica('replica')
+        Player.objects.filter(pk=winner.pk).update(first_name="changed")
+        self.assertContains(self.client.get('/scores/'), "Alice")
+
+
+class SnapshotTest(TransactionTestCase):
+    # transactions are real here, so a failed load can be seen rolling back
+    def setUp(self):
+        for levelno in (1, 2):
+            level = Level.objects.create(levelno=levelno)
+            for i in range(3):
+                question = Question.objects.create(
+                    text=u"Level %d question %d \u2713" % (levelno, i),
+                    level=level)
+                Answer.objects.create(text="Wrong", correct=False,
+                                      question=question)
+                Answer.objects.create(text="Right", correct=True,
+                                      question=question)
+
+    def bank(self):
+        return sorted((a.question.level.levelno, a.question.text, a.text,
+                       a.correct) for a in Answer.objects.all())
+
+    def export(self):
+        snapshot = StringIO()
+        trailer = write_snapshot(snapshot)
+        snapshot.seek(0)
+        return snapshot, trailer
+
+    def test_round_trip(self):
+        bank = self.bank()
+        snapshot, trailer = self.export()
+        self.assertEqual((trailer['levels'], trailer['questions'],
+                          trailer['answers']), (2, 6, 12))
+        counts = load_snapshot(snapshot, replace=True)
+        self.assertEqual(counts, {'levels': 2, 'questions': 6,
+                                  'answers': 12})
+        self.assertEqual(self.bank(), bank)
+        # sequences continue past the loaded pks
+        Question.objects.create(text="new", level=Level.objects.all()[0])
+
+    def test_append(self):
+        snapshot, _trailer = self.export()
+        load_snapshot(snapshot)
+        self.assertEqual(Question.objects.count(), 12)
+        self.assertEqual(Level.objects.count(), 2)
+
+    def tampered(self, old, new):
+        snapshot, _trailer = self.export()
+        data = gzip.GzipFile(fileobj=snapshot).read().replace(old, new)
+        tampered = StringIO()
+        out = gzip.GzipFile(fileobj=tampered, mode='wb')
+        out.write(data)
+        out.close()
+        tampered.seek(0)
+        return tampered
+
+    def test_checksum_mismatch(self):
+        bank = self.bank()
+        snapshot = self.tampered('Right', 'Wrong')
+        self.assertRaises(SnapshotError, load_snapshot, snapshot,
+                          replace=True)
+        self.assertEqual(self.bank(), bank)
+
+    def test_bad_version(self):
+        snapshot = self.tampered('"version":1', '"version":99')
+        self.assertRaises(SnapshotError, load_snapshot, snapshot)
+
+    def test_corrupt(self):
+        bank = self.bank()
+        snapshot, _trailer = self.export()
+        data = snapshot.getvalue()
+        # gzip CRC, not gzip at all, bad JSON, missing keys, bad shape
+        corrupt = [data[:-8] + '\0' * 4 + data[-4:],
+                   'not a snapshot',
+                   self.tampered('"level":1', '"level":1,').getvalue(),
+                   self.tampered('"correct"', '"right"').getvalue(),
+                   self.tampered('"questions":[', '"questions":["x",')
+                       .getvalue()]
+        for snapshot in corrupt:
+            self.assertRaises(SnapshotError, load_snapshot,
+                              StringIO(snapshot), replace=True)
+        self.assertEqual(self.bank(), bank)
+
+    def test_duplicate_levels(self):
+        duplicate = Level.objects.create(levelno=1)
+        snapshot, _trailer = self.export()
+        load_snapshot(snapshot)
+        self.assertEqual(Level.objects.filter(levelno=1).count(), 2)
+        self.assertEqual(duplicate.question_set.count(), 0)
+        self.assertEqual(Question.objects.count(), 12)
@@ -0,0 +1,119 @@
+"""Round timers shared by all active games.
+
+Each GameState records per-player answer deadlines. RoundTimers keeps the
+earliest deadline of every active game in a heap so that a single loop can
+sleep until the next player times out and only has to expire the games
+that are due.
+
+Deadlines are set by the web workers, which don't tell this loop about
+them, so run() still rescans the state of every incomplete game once per
+poll_interval to pick up new ones. A deadline set since the last scan is
+therefore handled up to poll_interval late.
+"""
+
+import time
+import heapq
+
+from mobigame.models import Game
+
+
+class RoundTimers(object):
+    """Min-heap of (deadline, game_pk).
+
+    Rescheduling a game pushes a new entry; stale entries are dropped when
+    they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {}  # game_pk -> deadline
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, game_pk, deadline):
+        """Set (or clear, if deadline is None) the deadline for a game."""
+        if deadline is None:
+            self._scheduled.pop(game_pk, None)
+            return
+        if self._scheduled.get(game_pk) == deadline:
+            return
+        self._scheduled[game_pk] = deadline
+        heapq.heappush(self._heap, (deadline, game_pk))
+
+    def _discard_stale(self):
+        while self._heap:
+            deadline, game_pk = self._heap[0]
+            if self._scheduled.get(game_pk) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        """Earliest scheduled deadline or None."""
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the pks of games with a deadline before now."""
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _deadline, game_pk = heapq.heappop(self._heap)
+            del self._scheduled[game_pk]
+            due.append(game_pk)
+            self._discard_stale()
+        return due
+
+
+def expire_game(game, now):
+    """Time out idle players in game and start the clock for the next
+    round. Returns the eliminated player pks and the next deadline.
+
+    The players' requests save the same state, so this goes through
+    GameState.update(): if a player answers while the game is being
+    expired, the deadlines are checked again against their answer.
+    """
+    gamestate = game.get_state()
+    deadline = gamestate.next_deadline()
+    if deadline is None or deadline > now:
+        return [], deadline
+
+    def expire(gamestate):
+        expired = gamestate.expire_idle_players(now)
+        if expired:
+            gamestate.arm_timers(now)
+        return expired
+    expired = gamestate.update(expire)
+    return expired, gamestate.next_deadline()
+
+
+def run(poll_interval=1.0, verbose=False):
+    """Eliminate idle players from all active games until interrupted.
+
+    New deadlines are picked up by rescanning every incomplete game each
+    poll_interval (see the module docstring). Needs a state store that is
+    shared between processes (the database or a cache); the process-local
+    memory store is invisible from here.
+    """
+    timers = RoundTimers()
+    while True:
+        now = time.time()
+        for game in Game.objects.filter(complete=False):
+            timers.schedule(game.pk, game.get_state().next_deadline())
+
+        for game_pk in timers.pop_due(now):
+            try:
+                game = Game.objects.get(pk=game_pk, complete=False)
+            except Game.DoesNotExist:
+                continue
+            expired, deadline = expire_game(game, now)
+            timers.schedule(game_pk, deadline)
+            if verbose and expired:
+                print "Game %s: timed out players %s" % (
+                    game_pk, ", ".join(expired))
+
+        wake = now + poll_interval
+        deadline = timers.next_deadline()
+        if deadline is not None:
+            wake = min(wake, deadline)
+        time.sleep(max(wake - time.time(), 0))
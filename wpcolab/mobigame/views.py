@@ -1,12 +1,17 @@
 """Mobi game views."""
 
+import re
+import uuid
 import random
 
+from django.conf import settings
+from django.core.cache import get_cache
 from django.shortcuts import redirect, render
 from django.forms import ModelForm
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 
-from mobigame.models import Game, Player
+from mobigame.models import Game, Player, Answer
+from mobigame.routers import replica_reads
 
 
 # Forms
@@ -18,6 +23,13 @@ class LoginForm(ModelForm):
         model = Player
         fields = ('first_name', 'colour')
 
+    def __init__(self, *args, **kw):
+        super(LoginForm, self).__init__(*args, **kw)
+        # an empty colour picks any free colour
+        colour = self.fields['colour']
+        colour.required = False
+        colour.choices = [('', 'Any colour')] + list(Player.COLOUR_CHOICES)
+
 
 # View decorators
 
@@ -37,6 +49,57 @@ def game_in_progress(view):
     return wrapper
 
 
+ANSWER_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+ANSWER_TIMEOUT = 5 * 60  # seconds to remember answered tokens
+
+
+def answer_cache():
+    return get_cache(getattr(settings, 'MOBIGAME_ANSWER_CACHE', 'default'))
+
+
+def idempotent_answer(view):
+    """Reject malformed answers and replay the response to a repeated one.
+
+    Every question form carries a random token. The response to the first
+    POST with a token is cached so that retries from flaky connections
+    don't reload and re-save the game state.
+
+    Unless the response is replayed, the answer is then looked up (before
+    the game state is loaded) and passed to the view as
+    request.mobigame_answer, a (pk, question pk, correct) tuple.
+    """
+    def wrapper(request):
+        if request.method != 'POST':
+            return view(request)
+        answer_pk = request.POST.get('answer', '')
+        token = request.POST.get('token', '')
+        if not answer_pk.isdigit():
+            return HttpResponseBadRequest("Invalid answer",
+                                          mimetype="text/plain")
+        player = request.session.get('player')
+        key = None
+        if player is not None and ANSWER_TOKEN_RE.match(token):
+            key = 'mobigame:answer:%s:%s' % (player.pk, token)
+            cache = answer_cache()
+            content = cache.get(key)
+            if content is not None:
+                return HttpResponse(content)
+
+        answers = list(Answer.objects.filter(pk=int(answer_pk))
+                       .values_list('pk', 'question', 'correct'))
+        if not answers:
+            return HttpResponseBadRequest("Invalid answer",
+                                          mimetype="text/plain")
+        request.mobigame_answer = answers[0]
+        response = view(request)
+        if key is not None and response.status_code == 200:
+            cache.set(key, response.content, ANSWER_TIMEOUT)
+        return response
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
 # Views
 
 def index(request):
@@ -50,18 +113,27 @@ def login(request):
     if request.method == 'POST':
         login_form = LoginForm(request.POST)
         if login_form.is_valid():
+            first_name = login_form.cleaned_data['first_name']
             colour = login_form.cleaned_data['colour']
-            if not gamestate.colour_used(colour):
-                player, _created = Player.objects.get_or_create(
-                                        **login_form.cleaned_data)
-                gamestate.add_player(player)
-                gamestate.save()
-                request.session['player'] = player
-                return redirect('mobigame:play')
+            if colour:
+                colours = [colour]
             else:
-                login_form.errors.setdefault('colour', [])
+                colours = gamestate.free_colours()
+            for candidate in colours:
+                if gamestate.colour_used(candidate):
+                    continue
+                player, _created = Player.objects.get_or_create(
+                                        first_name=first_name,
+                                        colour=candidate)
+                if gamestate.join(player, candidate):
+                    request.session['player'] = player
+                    return redirect('mobigame:play')
+            login_form.errors.setdefault('colour', [])
+            if colour:
                 login_form.errors['colour'].append('%s already taken!' %
                                                    colour.title())
+            else:
+                login_form.errors['colour'].append('All colours taken!')
     else:
         login_form = LoginForm()
 
@@ -77,8 +149,7 @@ def signout(request):
     if player is not None:
         game = Game.current_game()
         gamestate = game.get_state()
-        gamestate.eliminate_player(player)
-        gamestate.save()
+        gamestate.update(lambda gamestate: gamestate.eliminate_player(player))
         player.delete()
 
     login_form = LoginForm()
@@ -89,6 +160,7 @@ def signout(request):
     return render(request, 'signout.html', context)
 
 
+@replica_reads
 def scores(request):
     winners = Game.previous_winners(limit=10)
     current_winner = winners[0] if winners else None
@@ -116,6 +188,7 @@ WINNING_MSGS = {
     }
 
 
+@idempotent_answer
 @game_in_progress
 def play(game, gamestate, player, request):
     context = {
@@ -127,9 +200,12 @@ def play(game, gamestate, player, request):
 
     if request.method == 'POST':
         # answering a question
-        answer_pk = request.POST.get('answer')
-        answer_pk = int(answer_pk)
-        gamestate.answer(player, answer_pk)
+        answer_pk, question_pk, correct = request.mobigame_answer
+
+        def answer(gamestate):
+            gamestate.expire_idle_players()
+            gamestate.answer(player, answer_pk, question_pk, correct)
+        gamestate.update(answer)
         if gamestate.winner(player):
             context['winner_msg'] = \
                 WINNING_MSGS[player.colour]
@@ -143,32 +219,51 @@ def play(game, gamestate, player, request):
         else:
             template = 'madeit.html'
     else:
-        if not gamestate.full():
-            template = 'findafriend.html'
-        elif gamestate.level_no() == 0:
-            gamestate.seen_ready(player)
-            template = 'getready.html'
-        elif gamestate.player_ahead(player):
-            template = 'madeit.html'
-        else:
+        def prepare(gamestate):
+            """Return the template to show and the question, if any."""
+            gamestate.expire_idle_players()
+            gamestate.arm_timers()
+            # winners are eliminated too, so check for them first
+            if gamestate.winner(player):
+                return 'winner.html', None
+            elif gamestate.second(player):
+                return 'second.html', None
+            elif not gamestate.full():
+                return 'findafriend.html', None
+            elif gamestate.eliminated(player):
+                return 'eliminated.html', None
+            elif gamestate.level_no() == 0:
+                gamestate.seen_ready(player)
+                return 'getready.html', None
+            elif gamestate.player_ahead(player):
+                return 'madeit.html', None
             # ask a question!
-            template = 'play.html'
-            question = gamestate.current_question(player)
+            return 'play.html', gamestate.current_question(player)
+
+        template, question = gamestate.update(prepare)
+        if template == 'winner.html':
+            context['winner_msg'] = \
+                WINNING_MSGS[player.colour]
+        elif template == 'eliminated.html':
+            context['elimination_msg'] = \
+                random.choice(ELIMINATION_MSGS)
+        if question is not None:
             [answer1, answer2] = question.answer_set.all()
             context.update({
                 'levelno': question.level.levelno,
                 'question': question,
                 'answer1': answer1,
                 'answer2': answer2,
+                'answer_token': uuid.uuid4().hex,
                 })
 
-    gamestate.save()
     context['player_level'] = gamestate.player_level(player)
     return render(request, template, context)
 
 
 # API
 
+@replica_reads
 def api_v1(request):
     game = Game.last_game()
     if game is None:
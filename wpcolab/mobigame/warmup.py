@@ -0,0 +1,77 @@
+"""Warm up a freshly started worker before it serves players.
+
+Called from the gunicorn post_fork hook (see config/gunicorn.conf.py) so
+that the URLconf, question decks and templates are loaded before the
+first request rather than during it. Game state isn't preloaded: it
+changes on every request, so each request loads it anyway.
+"""
+
+import os
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.template.loader import get_template
+
+from mobigame.models import Level
+
+
+def template_names():
+    """Names of all the mobigame templates."""
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    return sorted(name for name in os.listdir(template_dir)
+                  if name.endswith('.html'))
+
+
+def load_urls():
+    # imports every URLconf (running admin.autodiscover()) and builds the
+    # reverse lookup tables
+    reverse('mobigame:index')
+
+
+def load_templates():
+    # kept between requests by mobigame.loaders.CachedLoader unless DEBUG
+    for name in template_names():
+        get_template(name)
+
+
+STAGES = [
+    ('urls', load_urls),
+    ('question decks', Level.load_decks),
+    ('templates', load_templates),
+    ]
+
+
+def warm_up(log=None):
+    """Run each warm-up stage and return [(stage, seconds)].
+
+    If log is given, a stage that fails is logged with log.exception() and
+    left out of the timings. Otherwise the error is raised.
+    """
+    timings = []
+    for name, stage in STAGES:
+        start = time.time()
+        try:
+            stage()
+        except Exception:
+            if log is None:
+                raise
+            log.exception("Warm-up stage %r failed" % name)
+            continue
+        timings.append((name, time.time() - start))
+    return timings
+
+
+def post_fork(server, worker):
+    """Gunicorn hook.
+
+    Warm-up is only an optimisation, so a failing stage is logged and the
+    worker boots anyway. An exception escaping this hook would stop the
+    worker with WORKER_BOOT_ERROR, and gunicorn would shut down.
+    """
+    if not getattr(settings, 'MOBIGAME_WARM_UP', True):
+        return
+    timings = warm_up(log=worker.log)
+    worker.log.info("Warmed up in %.3fs (%s)" % (
+        sum(seconds for _name, seconds in timings),
+        ", ".join("%s %.3fs" % timing for timing in timings)))
@@ -29,7 +29,39 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',  # Set to empty string for localhost.
         'PORT': '',  # Set to empty string for default.
-    }
+    },
+    # Read replica for scores and the hardware API. Locally this is a copy
+    # kept up to date by ./manage.py enlightenment_sync_replica; create its
+    # tables with ./manage.py syncdb --database=replica before the first
+    # sync.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'wpcolab-replica.db',
+        'USER': '',
+        'PASSWORD': '',
+        'HOST': '',
+        'PORT': '',
+    },
+}
+
+DATABASE_ROUTERS = ['mobigame.routers.ReplicaRouter']
+
+# Alias of the read replica and how many seconds it may lag behind the
+# primary before reads fall back to the primary.
+MOBIGAME_REPLICA_DB = 'replica'
+MOBIGAME_REPLICA_MAX_LAG = 5
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every worker on the box and the round timers (needs
+    # python-memcached and memcached -s /tmp/memcached.sock, see
+    # config/supervisord.conf).
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': 'unix:/tmp/memcached.sock',
+    },
 }
 
 # Local time zone for this installation. Choices can be found here:
@@ -98,13 +130,18 @@ STATICFILES_FINDERS = (
 SECRET_KEY = 'gvae2ij)y%#d51ih7ly(l*lu%t%emn+)dv_ymukw^)+acl@a%h'
 
 # List of callables that know how to import templates from various sources.
+# The outer loader keeps compiled templates between requests unless DEBUG
+# is on (they are preloaded when a worker starts, see mobigame/warmup.py).
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.Loader',
-    'django.template.loaders.app_directories.Loader',
-#     'django.template.loaders.eggs.Loader',
+    ('mobigame.loaders.CachedLoader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+#         'django.template.loaders.eggs.Loader',
+    )),
 )
 
 MIDDLEWARE_CLASSES = (
+    'mobigame.profiling.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -125,13 +162,23 @@ INSTALLED_APPS = (
     'django.contrib.sites',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'django.contrib.admin',
-    'django.contrib.admindocs',
     'mobigame',
     'gunicorn',
-    'sentry',
 )
 
+# Admin, admindocs and sentry aren't needed to serve games. Set
+# WPCOLAB_SERVE_ADMIN=0 to leave them out of game serving workers; in
+# production they are served by a separate gunicorn_admin program (see
+# config/supervisord.conf and config/nginx.conf).
+SERVE_ADMIN = os.environ.get('WPCOLAB_SERVE_ADMIN', '1') != '0'
+
+if SERVE_ADMIN:
+    INSTALLED_APPS += (
+        'django.contrib.admin',
+        'django.contrib.admindocs',
+        'sentry',
+    )
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error.
@@ -144,7 +191,11 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -152,5 +203,28 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'mobigame.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     }
 }
+
+# Where live game state is kept. One of:
+#   'mobigame.storage.DatabaseStateStore' (every change hits the database)
+#   'mobigame.storage.MemoryStateStore' (single worker only)
+#   'mobigame.storage.CacheStateStore' (shared via MOBIGAME_STATE_CACHE)
+# Completed games are always flushed to the database.
+MOBIGAME_STATE_STORE = 'mobigame.storage.DatabaseStateStore'
+MOBIGAME_STATE_CACHE = 'shared'
+
+# Preload URLs, question decks and templates when a gunicorn worker starts.
+MOBIGAME_WARM_UP = True
+
+# Cache remembering responses to answer submissions so that retries are
+# replayed instead of processed again.
+MOBIGAME_ANSWER_CACHE = 'default'
+
+# Where the request profiler writes collapsed stacks (switch it on in the
+# admin or with a signed X-Mobigame-Profile header).
+MOBIGAME_PROFILE_DIR = abspath('logs')
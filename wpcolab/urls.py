@@ -1,14 +1,18 @@
+from django.conf import settings
 from django.conf.urls.defaults import patterns, include, url
 
-from django.contrib import admin
-admin.autodiscover()
-
 urlpatterns = patterns('',
     # mobigame
     url(r'^', include('mobigame.urls', namespace='mobigame')),
-
-    # admin site
-    url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
-    url(r'^admin/', include(admin.site.urls)),
-    url(r'^sentry/', include('sentry.web.urls')),
 )
+
+if settings.SERVE_ADMIN:
+    from django.contrib import admin
+    admin.autodiscover()
+
+    urlpatterns += patterns('',
+        # admin site
+        url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
+        url(r'^admin/', include(admin.site.urls)),
+        url(r'^sentry/', include('sentry.web.urls')),
+    )